@@ -276,11 +276,12 @@ class Flow(TembaModel, SmartModel):
 
         # get all non-schedule based triggers that are active for these flows
         from temba.triggers.models import Trigger
-        triggers = set()
+        trigger_ids = set()
         for flow in flows:
-            triggers.update(flow.get_dependencies()['triggers'])
+            trigger_ids.update(t.pk for t in flow.get_dependencies()['triggers'])
 
         #triggers = Trigger.objects.filter(flow__in=flows, is_archived=False).exclude(trigger_type='S')
+        triggers = Trigger.objects.filter(pk__in=trigger_ids).select_related('flow').prefetch_related('groups')
         for trigger in triggers:
             exported_triggers.append(trigger.as_json())
 
@@ -1079,6 +1080,7 @@ class Flow(TembaModel, SmartModel):
         # archive our triggers as well
         from temba.triggers.models import Trigger
         Trigger.objects.filter(flow=self).update(is_archived=True)
+        Trigger.bump_cached_keywords(self.org_id)
 
     def restore(self):
         if self.flow_type == Flow.VOICE:
@@ -1089,6 +1091,11 @@ class Flow(TembaModel, SmartModel):
         self.save(update_fields=['is_archived'])
         # we don't know enough to restore triggers automatically
 
+        # but any already restored triggers of ours become matchable again, so invalidate the
+        # cached keyword set just like archive() does
+        from temba.triggers.models import Trigger
+        Trigger.bump_cached_keywords(self.org_id)
+
     def update_single_message_flow(self, message):
         self.flow_type = Flow.MESSAGE
         self.save(update_fields=['name', 'flow_type'])
@@ -613,6 +613,10 @@ class FlowCRUDL(SmartCRUDL):
                 else:
                     Trigger.objects.create(org=org, keyword=keyword, flow=obj, created_by=user, modified_by=user)
 
+            # the archive/unarchive branches above change triggers through queryset updates which
+            # bypass save(), so invalidate the cached keyword set ourselves
+            Trigger.bump_cached_keywords(org.pk)
+
             # run async task to update all runs
             from .tasks import update_run_expirations_task
             update_run_expirations_task.delay(obj.pk)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('triggers', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='trigger',
+            index_together=set([('org', 'trigger_type')]),
+        ),
+        # keywords are stored lower-cased from now on, normalize the ones already there so the
+        # exact-match lookup on inbound messages finds them. The original casing isn't recoverable
+        # so reversing is a no-op, but it shouldn't block unapplying the migration either.
+        migrations.RunSQL(
+            "UPDATE triggers_trigger SET keyword = lower(keyword) "
+            "WHERE keyword IS NOT NULL AND keyword != lower(keyword);",
+            "SELECT 1;"
+        ),
+        # partial index covering the inbound message keyword lookup
+        migrations.RunSQL(
+            "CREATE INDEX triggers_trigger_org_keyword_active ON triggers_trigger (org_id, keyword) "
+            "WHERE is_active = true AND is_archived = false;",
+            "DROP INDEX triggers_trigger_org_keyword_active;"
+        ),
+    ]
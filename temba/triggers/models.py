@@ -2,9 +2,13 @@ from __future__ import unicode_literals
 
 import re
 
+from uuid import uuid4
+
 from django.db import models
+from django.db.models import F, Q
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
+from redis_cache import get_redis_connection
 from smartmin.models import SmartModel
 from temba.contacts.models import Contact, ContactGroup
 from temba.orgs.models import Org
@@ -27,6 +31,15 @@ TRIGGER_TYPES = ((KEYWORD_TRIGGER, _("Keyword Trigger")),
                  (CATCH_ALL_TRIGGER, _("Catch All Trigger")),
                  (FOLLOW_TRIGGER, _("Follow Account Trigger")))
 
+KEYWORDS_VERSION_CACHE_KEY = 'triggers:keywords_version:%d'
+
+# compiled once so the message handling path never pays to parse the pattern again
+KEYWORD_REGEX = re.compile(r'\w+', re.UNICODE)
+
+# in-process cache of org_id -> (version, set of active trigger keywords), validated against the
+# version counter in redis so other processes invalidate us when triggers change
+_org_keywords = {}
+
 
 class Trigger(SmartModel):
 
@@ -67,23 +80,86 @@ class Trigger(SmartModel):
 
     channel = models.OneToOneField(Channel, verbose_name=_("Channel"), null=True, help_text=_("The associated channel"))
 
+    class Meta:
+        index_together = (('org', 'trigger_type'),)
+
     def __unicode__(self):
         if self.trigger_type == KEYWORD_TRIGGER:
             return self.keyword
         return self.get_trigger_type_display()
 
+    def save(self, *args, **kwargs):
+        # keywords are stored lower-cased so the message handling path can match them exactly
+        # against our partial index
+        if self.keyword:
+            self.keyword = self.keyword.lower()
+
+        super(Trigger, self).save(*args, **kwargs)
+        Trigger.bump_cached_keywords(self.org_id)
+
+    def _bump(self, when):
+        """
+        Records a firing of this trigger with a single atomic UPDATE of the two counters, rather
+        than rewriting the whole row and losing concurrent increments.
+        """
+        Trigger.objects.filter(pk=self.pk).update(trigger_count=F('trigger_count') + 1, last_triggered=when)
+
+    def delete(self, *args, **kwargs):
+        org_id = self.org_id
+        super(Trigger, self).delete(*args, **kwargs)
+        Trigger.bump_cached_keywords(org_id)
+
+    @classmethod
+    def bump_cached_keywords(cls, org_id):
+        """
+        Invalidates the cached keyword set for the given org, should be called whenever triggers are
+        changed outside of save(), e.g. by queryset updates.
+        """
+        r = get_redis_connection()
+        r.set(KEYWORDS_VERSION_CACHE_KEY % org_id, uuid4().hex)
+
+    @classmethod
+    def get_cached_keywords(cls, org):
+        """
+        Gets the set of lowercased keywords with an active keyword trigger for the given org. Kept
+        in process memory and revalidated with a single redis fetch, so the inbound message path can
+        rule out trigger handling without any database query.
+        """
+        r = get_redis_connection()
+        version = r.get(KEYWORDS_VERSION_CACHE_KEY % org.pk)
+
+        if version is None:
+            # no version means redis has no memory of this org, seed one rather than comparing on
+            # None, which a stale in-process entry from before a redis flush would happily match
+            r.setnx(KEYWORDS_VERSION_CACHE_KEY % org.pk, uuid4().hex)
+            version = r.get(KEYWORDS_VERSION_CACHE_KEY % org.pk)
+
+        cached = _org_keywords.get(org.pk)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        keywords = cls.objects.filter(org=org, trigger_type=KEYWORD_TRIGGER,
+                                      is_active=True, is_archived=False,
+                                      flow__is_active=True, flow__is_archived=False).values_list('keyword', flat=True)
+        keywords = {keyword.lower() for keyword in keywords if keyword}
+
+        _org_keywords[org.pk] = (version, keywords)
+        return keywords
+
     def name(self):
         return self.__unicode__()
 
     def as_json(self):
         """
-        An exportable dict representing our trigger
+        An exportable dict representing our trigger. Callers exporting many triggers should pass in a
+        queryset with select_related('flow') and prefetch_related('groups') so this doesn't hit the
+        database per trigger.
         """
         return dict(trigger_type=self.trigger_type,
                     keyword=self.keyword,
                     flow=dict(id=self.flow.pk, name=self.flow.name),
                     groups=[dict(id=group.pk, name=group.name) for group in self.groups.all()],
-                    channel=self.channel.pk if self.channel else None)
+                    channel=self.channel_id)
 
     @classmethod
     def import_triggers(cls, exported_json, org, user, site=None):
@@ -94,63 +170,106 @@ class Trigger(SmartModel):
         if exported_json.get('version', 0) < EARLIEST_IMPORT_VERSION:
             raise ValueError(_("Unknown version (%s)" % exported_json.get('version', 0)))
 
-        # first things first, let's create our groups if necesary and map their ids accordingly
-        if 'triggers' in exported_json:
-            for trigger_spec in exported_json['triggers']:
-
-                # resolve our groups
-                groups = []
-                for group_spec in trigger_spec['groups']:
+        trigger_specs = exported_json.get('triggers', [])
+        if not trigger_specs:
+            return
 
-                    group = None
+        same_site = site and site == exported_json.get('site', None)
 
-                    if site and site == exported_json.get('site', None):
-                        group = ContactGroup.objects.filter(org=org, pk=group_spec['id']).first()
+        # gather up every group and flow our specs reference so we can load them all in a handful of
+        # queries instead of one or more per spec
+        group_ids = set()
+        group_names = set()
+        flow_ids = set()
+        for trigger_spec in trigger_specs:
+            for group_spec in trigger_spec['groups']:
+                group_ids.add(group_spec['id'])
+                group_names.add(group_spec['name'])
+            flow_ids.add(trigger_spec['flow']['id'])
 
-                    if not group:
-                        group = ContactGroup.objects.filter(org=org, name=group_spec['name']).first()
+        groups_by_id = dict()
+        if same_site and group_ids:
+            groups_by_id = {g.pk: g for g in ContactGroup.objects.filter(org=org, pk__in=group_ids)}
 
-                    if not group:
-                        group = ContactGroup.create(org, user, group_spec['name'])
+        groups_by_name = dict()
+        if group_names:
+            groups_by_name = {g.name: g for g in ContactGroup.objects.filter(org=org, name__in=group_names)}
 
-                    if not group.is_active:
-                        group.is_active = True
-                        group.save()
+        flows_by_id = Flow.objects.filter(org=org).in_bulk(flow_ids)
 
-                    groups.append(group)
+        # and any existing triggers of the types we are importing, with their groups prefetched, so
+        # matching up specs doesn't cost a query per spec
+        trigger_types = {t['trigger_type'] for t in trigger_specs}
+        existing_triggers = list(Trigger.objects.filter(org=org, trigger_type__in=trigger_types)
+                                 .select_related('flow').prefetch_related('groups').order_by('pk'))
 
-                flow = Flow.objects.get(org=org, pk=trigger_spec['flow']['id'])
-
-                # see if that trigger already exists
-                trigger = Trigger.objects.filter(org=org, trigger_type=trigger_spec['trigger_type'])
-
-                if trigger_spec['keyword']:
-                    trigger = trigger.filter(keyword__iexact=trigger_spec['keyword'])
+        # first things first, let's create our groups if necesary and map their ids accordingly
+        for trigger_spec in trigger_specs:
+
+            # resolve our groups
+            groups = []
+            for group_spec in trigger_spec['groups']:
+
+                group = None
+
+                if same_site:
+                    group = groups_by_id.get(group_spec['id'])
+
+                if not group:
+                    group = groups_by_name.get(group_spec['name'])
+
+                if not group:
+                    group = ContactGroup.create(org, user, group_spec['name'])
+                    groups_by_name[group.name] = group
+
+                if not group.is_active:
+                    group.is_active = True
+                    group.save()
+
+                groups.append(group)
+
+            flow = flows_by_id.get(trigger_spec['flow']['id'])
+            if flow is None:
+                raise Flow.DoesNotExist("Flow matching query does not exist.")
+
+            # see if that trigger already exists
+            trigger = None
+            keyword = trigger_spec['keyword']
+            group_pks = {g.pk for g in groups}
+            for existing in existing_triggers:
+                if keyword and (not existing.keyword or existing.keyword.lower() != keyword.lower()):
+                    continue
+                if groups and not group_pks.intersection(g.pk for g in existing.groups.all()):
+                    continue
+                if existing.trigger_type == trigger_spec['trigger_type']:
+                    trigger = existing
+                    break
+
+            channel = trigger_spec.get('channel', None)  # older exports won't have a channel
+
+            if trigger:
+                trigger.is_archived = False
+                trigger.flow = flow
+                trigger.save()
+            else:
+                trigger = Trigger.objects.create(org=org, trigger_type=trigger_spec['trigger_type'],
+                                                 keyword=keyword, flow=flow,
+                                                 created_by=user, modified_by=user,
+                                                 channel=channel)
 
                 if groups:
-                    trigger = trigger.filter(groups__in=groups)
+                    trigger.groups.add(*groups)
 
-                trigger = trigger.first()
-
-                channel = trigger_spec.get('channel', None)  # older exports won't have a channel
-
-                if trigger:
-                    trigger.is_archived = False
-                    trigger.flow = flow
-                    trigger.save()
-                else:
-                    trigger = Trigger.objects.create(org=org, trigger_type=trigger_spec['trigger_type'],
-                                                     keyword=trigger_spec['keyword'], flow=flow,
-                                                     created_by=user, modified_by=user,
-                                                     channel=channel)
-
-                    for group in groups:
-                        trigger.groups.add(group)
+                # make sure a later spec in this same import can match the trigger we just created
+                existing_triggers.append(trigger)
 
 
     @classmethod
     def get_triggers_of_type(cls, org, trigger_type):
-        return Trigger.objects.filter(org=org, trigger_type=trigger_type, is_active=True, is_archived=False)
+        # callers almost always start the trigger's flow, so join it in rather than letting each
+        # access lazy-load it
+        return Trigger.objects.filter(org=org, trigger_type=trigger_type,
+                                      is_active=True, is_archived=False).select_related('flow')
 
     @classmethod
     def catch_triggers(cls, entity, trigger_type, channel_id=None):
@@ -171,52 +290,57 @@ class Trigger(SmartModel):
         if channel_id:
             triggers = triggers.filter(channel_id=channel_id)
 
-        for trigger in triggers:
-            trigger.flow.start([], [contact], start_msg=start_msg, restart_participants=True)
+        # we only ever start the flows, so grab their ids and load them in one query rather than
+        # hydrating every trigger and lazy-loading its flow
+        flow_ids = list(triggers.values_list('flow_id', flat=True))
 
-        return bool(triggers)
+        for flow in Flow.objects.in_bulk(flow_ids).values():
+            flow.start([], [contact], start_msg=start_msg, restart_participants=True)
+
+        return bool(flow_ids)
 
     @classmethod
     def find_and_handle(cls, msg):
-        # get the first word out of our message
-        words = re.split(r"[\W]+", msg.text.strip(), flags=re.UNICODE)
-
-        while words and not words[0]:
-            words = words[1:]
+        # get the first word out of our message with a single scan of the precompiled pattern,
+        # which also strips any punctuation stuck to the keyword
+        match = KEYWORD_REGEX.search(msg.text)
 
-        if not words:
+        if not match:
             return False
 
-        keyword = words[0].lower()
+        keyword = match.group(0).lower()
 
-        if not keyword:
+        # check our cached keyword set first, if this org has no active trigger for this keyword we
+        # can bail without touching the database at all
+        if keyword not in cls.get_cached_keywords(msg.org):
             return False
 
         active_run = FlowRun.objects.filter(is_active=True, contact=msg.contact, flow__is_active=True,
-                                            flow__is_archived=False).order_by("-created_on", "-pk").first()
+                                            flow__is_archived=False).select_related('flow').order_by("-created_on", "-pk").first()
 
         if active_run and active_run.flow.ignore_triggers and not active_run.is_completed():
             return False
 
-        groups_ids = msg.contact.groups.values_list('pk', flat=True)
+        # pin the contact's group ids down to a tuple so the queryset isn't re-run below
+        groups_ids = tuple(msg.contact.groups.values_list('pk', flat=True))
 
-        # Check first if we have a trigger for the contact groups
-        matching = Trigger.objects.filter(is_archived=False, is_active=True, org=msg.org, keyword__iexact=keyword,
-                                          flow__is_archived=False, flow__is_active=True, groups__in=groups_ids).order_by('groups__name').prefetch_related('groups', 'groups__contacts')
+        # keywords are stored lower-cased so an exact match hits our partial index directly
+        matching = Trigger.objects.filter(is_archived=False, is_active=True, org=msg.org, keyword=keyword,
+                                          flow__is_archived=False, flow__is_active=True)
 
-        # If no trigger for contact groups find there is a no group trigger
-        if not matching:
-            matching = Trigger.objects.filter(is_archived=False, is_active=True, org=msg.org, keyword__iexact=keyword,
-                                              flow__is_archived=False, flow__is_active=True, groups=None).prefetch_related('groups', 'groups__contacts')
+        if groups_ids:
+            # one query handles both cases, a trigger for one of the contact's groups wins over a
+            # trigger with no group, which sorts last since its group name is NULL
+            matching = matching.filter(Q(groups__in=groups_ids) | Q(groups=None)).order_by('groups__name')
+        else:
+            matching = matching.filter(groups=None)
 
-        if not matching:
-            return False
+        trigger = matching.select_related('flow').only('pk', 'flow').first()
 
-        trigger = matching[0]
+        if not trigger:
+            return False
 
-        trigger.last_triggered = msg.created_on
-        trigger.trigger_count += 1
-        trigger.save()
+        trigger._bump(msg.created_on)
 
         contact = msg.contact
 
@@ -228,84 +352,99 @@ class Trigger(SmartModel):
     @classmethod
     def find_flow_for_inbound_call(cls, contact):
 
-        groups_ids = contact.groups.values_list('pk', flat=True)
+        # pin the contact's group ids down to a tuple so the queryset isn't re-run below
+        groups_ids = tuple(contact.groups.values_list('pk', flat=True))
 
-        # Check first if we have a trigger for the contact groups
         matching = Trigger.objects.filter(is_archived=False, is_active=True, org=contact.org, trigger_type=INBOUND_CALL_TRIGGER,
-                                          flow__is_archived=False, flow__is_active=True, groups__in=groups_ids).order_by('groups__name').prefetch_related('groups', 'groups__contacts')
+                                          flow__is_archived=False, flow__is_active=True)
 
-        # If no trigger for contact groups find there is a no group trigger
-        if not matching:
-            matching = Trigger.objects.filter(is_archived=False, is_active=True, org=contact.org, trigger_type=INBOUND_CALL_TRIGGER,
-                                              flow__is_archived=False, flow__is_active=True, groups=None).prefetch_related('groups', 'groups__contacts')
+        if groups_ids:
+            # one query handles both cases, a trigger for one of the contact's groups wins over a
+            # trigger with no group, which sorts last since its group name is NULL
+            matching = matching.filter(Q(groups__in=groups_ids) | Q(groups=None)).order_by('groups__name')
+        else:
+            matching = matching.filter(groups=None)
 
-        if not matching:
-            return None
+        trigger = matching.select_related('flow').only('pk', 'flow').first()
 
-        trigger = matching[0]
-        trigger.last_triggered = timezone.now()
-        trigger.trigger_count += 1
-        trigger.save()
+        if not trigger:
+            return None
+        trigger._bump(timezone.now())
 
         return trigger.flow
 
     @classmethod
     def apply_action_archive(cls, triggers):
-        triggers.update(is_archived=True)
-        return [each_trigger.pk for each_trigger in triggers]
+        # evaluate the queryset once, we only need pks and org ids and don't want the later
+        # operations re-selecting every row
+        rows = list(triggers.values_list('pk', 'org_id'))
+        pks = [pk for pk, org_id in rows]
+
+        Trigger.objects.filter(pk__in=pks).update(is_archived=True)
+
+        for org_id in {org_id for pk, org_id in rows}:
+            cls.bump_cached_keywords(org_id)
+
+        return pks
 
     @classmethod
     def apply_action_restore(cls, triggers):
+        # evaluate the incoming queryset once so the filters and the return value below don't each
+        # re-select every row
+        pks = list(triggers.values_list('pk', flat=True))
+        triggers = Trigger.objects.filter(pk__in=pks)
+
         m_last_triggered = triggers.filter(trigger_type=MISSED_CALL_TRIGGER).order_by('-last_triggered', '-modified_on')
         c_last_triggered = triggers.filter(trigger_type=CATCH_ALL_TRIGGER).order_by('-last_triggered', '-modified_on')
 
-        remaining_triggers = triggers.exclude(pk__in=m_last_triggered).exclude(pk__in=c_last_triggered)
-
-        for trigger in remaining_triggers:
+        remaining_triggers = list(triggers.exclude(pk__in=m_last_triggered).exclude(pk__in=c_last_triggered))
 
-            if trigger.keyword:
-                same_keyword_triggers = Trigger.objects.filter(org=trigger.org, keyword=trigger.keyword, is_archived=False, is_active=True,
-                                                               trigger_type=KEYWORD_TRIGGER)
-                if same_keyword_triggers:
-                    same_keyword_triggers.update(is_archived=True)
+        # archive every active trigger that clashes with a keyword we are restoring, in one query
+        # instead of one per restored trigger
+        keywords = {t.keyword for t in remaining_triggers if t.keyword}
+        if keywords:
+            Trigger.objects.filter(org_id=remaining_triggers[0].org_id, keyword__in=keywords,
+                                   is_archived=False, is_active=True,
+                                   trigger_type=KEYWORD_TRIGGER).update(is_archived=True)
 
-            trigger.is_archived = False
-            trigger.save()
+        if remaining_triggers:
+            Trigger.objects.filter(pk__in=[t.pk for t in remaining_triggers]).update(is_archived=False)
+            cls.bump_cached_keywords(remaining_triggers[0].org_id)
 
-        if m_last_triggered:
+        latest_missed = m_last_triggered.values_list('pk', 'org_id').first()
+        if latest_missed:
             # first archive all our missed call triggers and unarchive the last triggered in the selected
-            Trigger.objects.filter(org=m_last_triggered[0].org,
+            missed_pk, org_id = latest_missed
+            Trigger.objects.filter(org_id=org_id,
                                    trigger_type=MISSED_CALL_TRIGGER,
                                    is_active=True).update(is_archived=True)
-            m_last_triggered[0].is_archived = False
-            m_last_triggered[0].save()
+            Trigger.objects.filter(pk=missed_pk).update(is_archived=False)
 
-        if c_last_triggered:
+        latest_catch_all = c_last_triggered.values_list('pk', 'org_id').first()
+        if latest_catch_all:
             # first archive all our catch all message triggers and unarchive the last triggered in the selected
-            Trigger.objects.filter(org=c_last_triggered[0].org,
+            catch_all_pk, org_id = latest_catch_all
+            Trigger.objects.filter(org_id=org_id,
                                    trigger_type=CATCH_ALL_TRIGGER,
                                    is_active=True).update(is_archived=True)
-            c_last_triggered[0].is_archived = False
-            c_last_triggered[0].save()
+            Trigger.objects.filter(pk=catch_all_pk).update(is_archived=False)
 
-        return [each_trigger.pk for each_trigger in triggers]
+        return pks
 
     def fire(self):
         if self.is_archived or not self.is_active:
             return None
 
-        channels = self.flow.org.channels.all()
-        if not channels:
+        # use our own org rather than traversing flow.org, which costs two lazy loads
+        if not self.org.channels.exists():
             return None
 
-        groups = list(self.groups.all())
-        contacts = list(self.contacts.all())
+        if self.groups.exists() or self.contacts.exists():
+            groups = list(self.groups.all())
+            contacts = list(self.contacts.all())
 
-        if groups or contacts:
-            self.last_triggered = timezone.now()
-            self.trigger_count += 1
-            self.save()
+            self._bump(timezone.now())
 
-            return self.flow.start(groups, contacts, restart_participants=True) 
+            return self.flow.start(groups, contacts, restart_participants=True)
 
         return False
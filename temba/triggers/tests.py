@@ -13,7 +13,7 @@ from temba.schedules.models import Schedule
 from temba.msgs.models import Msg, INCOMING, Call, CALL_IN_MISSED
 from temba.channels.models import SEND, CALL, ANSWER, RECEIVE
 from temba.tests import TembaTest
-from .models import Trigger, MISSED_CALL_TRIGGER, CATCH_ALL_TRIGGER, INBOUND_CALL_TRIGGER
+from .models import Trigger, KEYWORD_TRIGGER, MISSED_CALL_TRIGGER, CATCH_ALL_TRIGGER, INBOUND_CALL_TRIGGER
 
 
 class TriggerTest(TembaTest):
@@ -713,3 +713,101 @@ class TriggerTest(TembaTest):
         # incoming4 should not be handled
         self.assertFalse(Trigger.find_and_handle(incoming4))
 
+    def test_keyword_cache(self):
+        self.login(self.admin)
+
+        contact = self.create_contact('Ben', '+250788382382')
+        flow = self.create_flow()
+
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertFalse(Trigger.find_and_handle(incoming))
+
+        # with the keyword set warmed up, a miss shouldn't hit the database at all
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        with self.assertNumQueries(0):
+            self.assertFalse(Trigger.find_and_handle(incoming))
+
+        # creating a trigger invalidates the cached set
+        trigger = Trigger.objects.create(org=self.org, keyword='join', flow=flow,
+                                         created_by=self.admin, modified_by=self.admin)
+
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertTrue(Trigger.find_and_handle(incoming))
+
+        # archiving from the trigger list action does too
+        post_data = dict(action='archive', objects=trigger.pk)
+        self.client.post(reverse('triggers.trigger_list'), post_data)
+
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertFalse(Trigger.find_and_handle(incoming))
+
+        # as does restoring from the archived list
+        post_data = dict(action='restore', objects=trigger.pk)
+        self.client.post(reverse('triggers.trigger_archived'), post_data)
+
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertTrue(Trigger.find_and_handle(incoming))
+
+        # archiving the flow archives its triggers and must invalidate as well
+        flow.archive()
+
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertFalse(Trigger.find_and_handle(incoming))
+
+        flow.restore()
+        Trigger.apply_action_restore(Trigger.objects.filter(pk=trigger.pk))
+
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertTrue(Trigger.find_and_handle(incoming))
+
+        # restoring in the other order, trigger first while its flow is still archived, then the
+        # flow, must also bring the keyword back
+        flow.archive()
+        Trigger.apply_action_restore(Trigger.objects.filter(pk=trigger.pk))
+
+        # the flow is still archived so no match, and this rebuilds the cached set without our keyword
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertFalse(Trigger.find_and_handle(incoming))
+
+        # restoring the flow must invalidate that set
+        flow.restore()
+
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertTrue(Trigger.find_and_handle(incoming))
+
+        # removing the keyword on the flow edit form archives its trigger
+        post_data = dict(name="Color Flow", keyword_triggers='', expires_after_minutes=60*12)
+        self.client.post(reverse('flows.flow_update', args=[flow.pk]), post_data)
+
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertFalse(Trigger.find_and_handle(incoming))
+
+        # and re-adding it through the form unarchives it and must bring the keyword back
+        post_data = dict(name="Color Flow", keyword_triggers='join', expires_after_minutes=60*12)
+        self.client.post(reverse('flows.flow_update', args=[flow.pk]), post_data)
+
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertTrue(Trigger.find_and_handle(incoming))
+
+        # deleting the trigger invalidates too
+        trigger.delete()
+
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="join")
+        self.assertFalse(Trigger.find_and_handle(incoming))
+
+    def test_trigger_import_keyword_casing(self):
+        flow = self.create_flow()
+
+        trigger_spec = dict(trigger_type=KEYWORD_TRIGGER, keyword='Join', groups=[],
+                            flow=dict(id=flow.pk, name=flow.name))
+        Trigger.import_triggers(dict(version=4, triggers=[trigger_spec]), self.org, self.admin)
+
+        # keywords are normalized to lower case on save
+        trigger = Trigger.objects.get(flow=flow)
+        self.assertEquals('join', trigger.keyword)
+
+        # and still match inbound messages whatever case they were imported with
+        contact = self.create_contact('Ben', '+250788382382')
+        incoming = self.create_msg(direction=INCOMING, contact=contact, text="Join us")
+        self.assertTrue(Trigger.find_and_handle(incoming))
+